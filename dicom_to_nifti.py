@@ -1,4 +1,6 @@
+import errno
 import os
+import re
 import shutil
 import subprocess
 
@@ -16,20 +18,39 @@ def convert_dicom_to_nifti(dicom_folder, nii_output_folder, json_output_folder,
     os.makedirs(nii_output_folder, exist_ok=True)
     os.makedirs(json_output_folder, exist_ok=True)
 
-    modality_index = 1
+    # Archivos ya presentes antes de la conversión, para renombrar solo los nuevos;
+    # la numeración continúa después de la de ejecuciones anteriores
+    existentes = set(os.listdir(nii_output_folder))
+    modality_index = siguiente_indice(existentes | set(os.listdir(json_output_folder)), case_prefix)
 
     print(f"Convirtiendo archivos DICOM de {dicom_folder} a NIfTI...")
+    # '-z o' comprime en paralelo con pigz; con una sola CPU se usa el compresor interno
+    compresion = "o" if (os.cpu_count() or 1) > 1 else "i"
     dcm2niix_cmd = [
         "dcm2niix",
-        "-z", "y",
+        "-z", compresion,
         "-o", nii_output_folder,
         dicom_folder
     ]
-    subprocess.run(dcm2niix_cmd, check=True)
+    # Se descarta el progreso por corte de dcm2niix para no bufferizarlo en Python
+    subprocess.run(dcm2niix_cmd, check=True, stdout=subprocess.DEVNULL)
 
-    renombrar_archivos(nii_output_folder, json_output_folder, case_prefix, modality_index)
+    nuevos = set(os.listdir(nii_output_folder)) - existentes
+    renombrar_archivos(nii_output_folder, json_output_folder, case_prefix, modality_index, nuevos)
 
-def renombrar_archivos(nii_output_folder, json_output_folder, case_prefix, modality_index):
+def siguiente_indice(nombres, case_prefix):
+    """
+    Devuelve el índice siguiente al mayor '{case_prefix}_NN_0000' ya presente (1 si no hay ninguno).
+    
+    Parametros:
+    nombres (iterable): Nombres de archivo existentes (.nii.gz y .json).
+    case_prefix (str): Prefijo usado en los archivos renombrados.
+    """
+    patron = re.compile(rf"^{re.escape(case_prefix)}_(\d+)_0000\.(?:nii\.gz|json)$")
+    indices = [int(m.group(1)) for m in map(patron.match, nombres) if m]
+    return max(indices, default=0) + 1
+
+def renombrar_archivos(nii_output_folder, json_output_folder, case_prefix, modality_index, archivos=None):
     """
     Renombra los archivos .nii.gz y .json generados por dcm2niix, 
     y mueve los archivos .json a la carpeta de salida de JSON.
@@ -39,27 +60,47 @@ def renombrar_archivos(nii_output_folder, json_output_folder, case_prefix, modal
     json_output_folder (str): Carpeta donde se moverán los archivos JSON renombrados.
     case_prefix (str): Prefijo que se usará para los archivos renombrados (por defecto "time").
     modality_index (int): Índice inicial para numerar las temporalidades (se incrementa con cada archivo).
+    archivos (set): Nombres de archivo a procesar (por defecto todos los de la carpeta).
     """
-    for archivo in os.listdir(nii_output_folder):
-        if archivo.endswith(".nii.gz"):
-            base_name = archivo.split('.nii.gz')[0]
-            new_name_nii = f"{case_prefix}_{modality_index:02d}_0000.nii.gz"
-            ruta_vieja_nii = os.path.join(nii_output_folder, archivo)
-            ruta_nueva_nii = os.path.join(nii_output_folder, new_name_nii)
-            os.rename(ruta_vieja_nii, ruta_nueva_nii)
-            print(f"Renombrado NIfTI: {ruta_vieja_nii} -> {ruta_nueva_nii}")
+    # Una sola pasada por la carpeta; DirEntry ya trae el tipo de archivo en caché
+    with os.scandir(nii_output_folder) as it:
+        todas = {entrada.name for entrada in it if entrada.is_file()}
+    with os.scandir(json_output_folder) as it:
+        jsons_destino = {entrada.name for entrada in it}
+    entradas = todas if archivos is None else todas & set(archivos)
+
+    bases_nii = sorted(nombre[:-len(".nii.gz")] for nombre in entradas if nombre.endswith(".nii.gz"))
+    for base_name in bases_nii:
+        new_name_nii = f"{case_prefix}_{modality_index:02d}_0000.nii.gz"
+        ruta_vieja_nii = os.path.join(nii_output_folder, base_name + ".nii.gz")
+        ruta_nueva_nii = os.path.join(nii_output_folder, new_name_nii)
+        # os.replace sobrescribe en silencio: nunca pisar archivos existentes
+        if new_name_nii in todas:
+            raise FileExistsError(f"Ya existe {ruta_nueva_nii}; no se sobrescribe")
+        os.replace(ruta_vieja_nii, ruta_nueva_nii)
+        todas.add(new_name_nii)
+        print(f"Renombrado NIfTI: {ruta_vieja_nii} -> {ruta_nueva_nii}")
 
-            json_name = base_name + ".json"
+        json_name = base_name + ".json"
+        if json_name in entradas:
             ruta_vieja_json = os.path.join(nii_output_folder, json_name)
-            if os.path.exists(ruta_vieja_json):
-                new_name_json = f"{case_prefix}_{modality_index:02d}_0000.json"
-                ruta_nueva_json = os.path.join(json_output_folder, new_name_json)
+            new_name_json = f"{case_prefix}_{modality_index:02d}_0000.json"
+            ruta_nueva_json = os.path.join(json_output_folder, new_name_json)
+            if new_name_json in jsons_destino:
+                raise FileExistsError(f"Ya existe {ruta_nueva_json}; no se sobrescribe")
+            try:
+                os.replace(ruta_vieja_json, ruta_nueva_json)
+            except OSError as e:
+                # Carpeta JSON en otro sistema de archivos: copiar y borrar
+                if e.errno != errno.EXDEV:
+                    raise
                 shutil.move(ruta_vieja_json, ruta_nueva_json)
-                print(f"Renombrado y movido JSON: {ruta_vieja_json} -> {ruta_nueva_json}")
-            else:
-                print(f"Falta archivo JSON para: {new_name_nii}")
+            jsons_destino.add(new_name_json)
+            print(f"Renombrado y movido JSON: {ruta_vieja_json} -> {ruta_nueva_json}")
+        else:
+            print(f"Falta archivo JSON para: {new_name_nii}")
 
-            modality_index += 1
+        modality_index += 1
 
 # CAMBIAR PARA GUSTO PERSONAL
 
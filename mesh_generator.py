@@ -1,56 +1,159 @@
 import nibabel as nib
-from skimage import measure
 import pyvista as pv
 import os
 import numpy as np
-from medpy.filter.smoothing import anisotropic_diffusion
+from numba import njit, prange
 import vtk
+from vtk.util.numpy_support import numpy_to_vtk
 
 pv.set_plot_theme('document')
 
+# Función para activar el backend SMP de VTK con más hilos disponible en la compilación
+def setup_vtk_threading(backends=('TBB', 'OpenMP', 'STDThread')):
+    # La elección de backend en tiempo de ejecución requiere VTK >= 9.1; en versiones
+    # anteriores solo se fija el número de hilos del backend compilado
+    if not hasattr(vtk.vtkSMPTools, 'SetBackend'):
+        vtk.vtkSMPTools.Initialize(os.cpu_count() or 1)
+        return None
+    # VTK escribe directamente en stderr al probar un backend no compilado
+    stderr_fd = os.dup(2)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull_fd, 2)
+        for backend in backends:
+            if vtk.vtkSMPTools.SetBackend(backend):
+                break
+    finally:
+        os.dup2(stderr_fd, 2)
+        os.close(stderr_fd)
+        os.close(devnull_fd)
+    vtk.vtkSMPTools.Initialize(os.cpu_count() or 1)
+    return vtk.vtkSMPTools.GetBackend()
+
+# Conductancia de Perona-Malik multiplicada por la diferencia (flujo)
+@njit(inline='always', fastmath=True)
+def _flux(delta, inv_k2, option):
+    if option == 1:
+        return np.exp(-delta * delta * inv_k2) * delta
+    return delta / (1.0 + delta * delta * inv_k2)
+
+# Kernel de difusión anisotrópica (Perona-Malik): buffers float32 reservados una sola vez
+@njit(parallel=True, fastmath=True, cache=True)
+def _perona_malik_kernel(volume, niter, kappa, gamma, sx, sy, sz, option):
+    nx, ny, nz = volume.shape
+    out = volume.copy()
+    # Flujo hacia adelante en cada eje; queda en cero en la última posición (flujo nulo en el borde)
+    flux_x = np.zeros_like(volume)
+    flux_y = np.zeros_like(volume)
+    flux_z = np.zeros_like(volume)
+    inv_k2 = np.float32(1.0 / (kappa * kappa))
+    gx = np.float32(gamma / sx)
+    gy = np.float32(gamma / sy)
+    gz = np.float32(gamma / sz)
+    for _ in range(niter):
+        for i in prange(nx):
+            for j in range(ny):
+                for k in range(nz):
+                    center = out[i, j, k]
+                    if i < nx - 1:
+                        flux_x[i, j, k] = _flux(out[i + 1, j, k] - center, inv_k2, option)
+                    if j < ny - 1:
+                        flux_y[i, j, k] = _flux(out[i, j + 1, k] - center, inv_k2, option)
+                    if k < nz - 1:
+                        flux_z[i, j, k] = _flux(out[i, j, k + 1] - center, inv_k2, option)
+        # Divergencia del flujo: diferencia con el flujo del vecino anterior
+        for i in prange(nx):
+            for j in range(ny):
+                for k in range(nz):
+                    div = gx * flux_x[i, j, k] + gy * flux_y[i, j, k] + gz * flux_z[i, j, k]
+                    if i > 0:
+                        div -= gx * flux_x[i - 1, j, k]
+                    if j > 0:
+                        div -= gy * flux_y[i, j - 1, k]
+                    if k > 0:
+                        div -= gz * flux_z[i, j, k - 1]
+                    out[i, j, k] += div
+    return out
+
+# Función para aplicar difusión anisotrópica 3D sobre float32 (reemplaza a medpy.anisotropic_diffusion)
+def perona_malik3d(volume, niter=5, kappa=50, gamma=0.1, voxelspacing=(1.0, 1.0, 1.0), option=1):
+    # 'option' 1 usa exp(-(d/kappa)^2) como conductancia, 2 usa 1/(1+(d/kappa)^2)
+    if option not in (1, 2):
+        raise ValueError("option debe ser 1 o 2")
+    volume = np.ascontiguousarray(volume, dtype=np.float32)
+    sx, sy, sz = (float(s) for s in voxelspacing[:3])
+    return _perona_malik_kernel(volume, int(niter), float(kappa), float(gamma), sx, sy, sz, option)
+
 # Función para cargar el archivo NIfTI y obtener los datos de segmentación y espaciado
 def load_segmentation(nifti_path, target_label=1):
     if not os.path.exists(nifti_path):
         raise FileNotFoundError(f"Archivo no encontrado: {nifti_path}")
     
-    img = nib.load(nifti_path)
-    segmentation_data = img.get_fdata()
+    img = nib.load(nifti_path, mmap=False)
+    segmentation_data = np.asanyarray(img.dataobj)
     spacing = img.header.get_zooms()
     
-    # Filtrar solo el ventrículo izquierdo
-    segmentation_data = (segmentation_data == target_label).astype(np.float32)
+    # Filtrar solo el ventrículo izquierdo (máscara binaria en uint8, 1 byte por vóxel)
+    segmentation_data = (segmentation_data == target_label).astype(np.uint8)
     
     return segmentation_data, spacing
 
-# Función para generar una malla usando el algoritmo Marching Cubes
+# Función para recortar el volumen a la caja envolvente de los vóxeles sobre 'level'
+def crop_to_segmentation(segmentation_data, level=0.5):
+    # Se agrega 1 vóxel de margen para cerrar la superficie; así no se recorre
+    # el espacio vacío que rodea al ventrículo
+    mask = segmentation_data > level
+    if not mask.any():
+        raise ValueError(f"No hay vóxeles sobre el nivel {level} para generar la malla")
+    start, stop = [], []
+    for axis in range(3):
+        others = tuple(a for a in range(3) if a != axis)
+        indices = np.flatnonzero(mask.any(axis=others))
+        start.append(max(int(indices[0]) - 1, 0))
+        stop.append(min(int(indices[-1]) + 2, segmentation_data.shape[axis]))
+    sub_volume = segmentation_data[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]]
+    return sub_volume, start
+
+# Función para envolver un volumen NumPy en un vtkImageData
+def to_vtk_image(volume, spacing, start=(0, 0, 0)):
+    # VTK recorre X más rápido (orden Fortran); una máscara uint8 se pasa como
+    # VTK_UNSIGNED_CHAR. El origen desplaza un subvolumen a las coordenadas del volumen completo
+    spacing = [float(s) for s in spacing[:3]]
+    image = vtk.vtkImageData()
+    image.SetDimensions(volume.shape)
+    image.SetSpacing(spacing)
+    image.SetOrigin([start[i] * spacing[i] for i in range(3)])
+    scalars = numpy_to_vtk(volume.ravel(order='F'), deep=True)
+    image.GetPointData().SetScalars(scalars)
+    return image
+
+# Función para generar una malla usando el algoritmo Flying Edges de VTK
 def generate_mesh(segmentation_data, spacing, level=0.5):
+    sub_volume, start = crop_to_segmentation(segmentation_data, level)
+    image = to_vtk_image(sub_volume, spacing, start)
+    
     # Parámetro: 'level' controla el nivel de isosuperficie para extraer la malla.
     # Por qué cambiarlo: Si la malla no representa correctamente la forma del corazón,
     # puedes ajustar este valor para mejorar la extracción de la superficie.
     # Valores a probar: 0.4, 0.5 (por defecto), 0.6
-    verts, faces, normals, values = measure.marching_cubes(
-        segmentation_data,
-        level=level,
-        spacing=spacing,
-        step_size=1  # Parámetro: 'step_size' controla la resolución de la malla.
-                     # Por qué cambiarlo: Valores menores aumentan el detalle de la malla pero incrementan el tiempo de procesamiento.
-                     # Valores a probar: 1 (por defecto), 2, 3
-    )
-    print(f"Número de vértices generados: {len(verts)}")
-    print(f"Número de caras generadas: {len(faces)}")
-    return verts, faces
+    flying_edges = vtk.vtkFlyingEdges3D()
+    flying_edges.SetInputData(image)
+    flying_edges.SetValue(0, level)
+    flying_edges.ComputeNormalsOn()
+    flying_edges.ComputeGradientsOff()
+    flying_edges.Update()
+    
+    # Flying Edges fusiona los puntos compartidos, no se requiere limpieza posterior
+    mesh = pv.wrap(flying_edges.GetOutput())
+    print(f"Número de vértices generados: {mesh.n_points}")
+    print(f"Número de caras generadas: {mesh.n_cells}")
+    return mesh
 
-# Función para crear y suavizar la malla usando PyVista y Taubin Smoothing
-def create_smooth_mesh(verts, faces):
+# Función para suavizar la malla usando PyVista y Taubin Smoothing
+def create_smooth_mesh(mesh):
     try:
-        print("Creando la malla con PyVista...")
-        
-        n_faces = faces.shape[0]
-        faces_formatted = np.hstack([np.full((n_faces, 1), 3), faces]).astype(np.int64)
-        faces_formatted = faces_formatted.ravel()
+        print("Extrayendo la componente principal de la malla...")
         
-        mesh = pv.PolyData(verts, faces_formatted)
-        mesh.clean(inplace=True)
         mesh = mesh.connectivity(extraction_mode='largest')
         
         print(f"Vértices antes del suavizado: {mesh.n_points}")
@@ -114,6 +217,39 @@ def visualize_mesh_advanced(mesh):
     plotter.show_axes()
     plotter.show()
 
+# Función para visualizar la isosuperficie directamente en la GPU, sin generar la malla
+def visualize_isosurface_gpu(segmentation_data, spacing, level=0.5):
+    # vtkSmartVolumeMapper usa el ray casting por GPU cuando hay soporte OpenGL y
+    # recalcula la isosuperficie en cada cuadro; útil para revisar 'level' y el filtrado
+    # antes de correr Flying Edges y el suavizado
+    sub_volume, start = crop_to_segmentation(segmentation_data, level)
+    image = to_vtk_image(sub_volume, spacing, start)
+    
+    mapper = vtk.vtkSmartVolumeMapper()
+    mapper.SetBlendModeToIsoSurface()
+    mapper.SetInputData(image)
+    
+    color = vtk.vtkColorTransferFunction()
+    color.AddRGBPoint(level, 1.0, 0.0, 0.0)
+    opacity = vtk.vtkPiecewiseFunction()
+    opacity.AddPoint(level, 1.0)
+    
+    volume_property = vtk.vtkVolumeProperty()
+    volume_property.SetColor(color)
+    volume_property.SetScalarOpacity(opacity)
+    volume_property.ShadeOn()
+    volume_property.SetInterpolationTypeToLinear()
+    volume_property.GetIsoSurfaceValues().SetValue(0, level)
+    
+    volume = vtk.vtkVolume()
+    volume.SetMapper(mapper)
+    volume.SetProperty(volume_property)
+    
+    plotter = pv.Plotter()
+    plotter.add_actor(volume)
+    plotter.show_axes()
+    plotter.show()
+
 # Función para guardar la malla en un archivo STL
 def save_mesh(mesh, output_path):
     output_dir = os.path.dirname(output_path)
@@ -130,6 +266,8 @@ def save_mesh(mesh, output_path):
 nifti_path = 'time_01.nii.gz'
 
 if __name__ == "__main__":
+    setup_vtk_threading()
+    
     try:
         segmentation_data, spacing = load_segmentation(nifti_path, target_label=1)
         print("Segmentación cargada correctamente.")
@@ -144,7 +282,7 @@ if __name__ == "__main__":
         # 'gamma' controla la velocidad de difusión (debe ser <= 0.25 para estabilidad).
         # Por qué cambiarlo: Ajusta la intensidad del filtrado en cada iteración.
         # Valores a probar: 0.1 (por defecto), 0.2, 0.25
-        segmentation_data_filtered = anisotropic_diffusion(
+        segmentation_data_filtered = perona_malik3d(
             segmentation_data,
             niter=5,
             kappa=50,
@@ -154,10 +292,10 @@ if __name__ == "__main__":
         )
         print("Filtrado de difusión anisotrópica aplicado.")
         
-        verts, faces = generate_mesh(segmentation_data_filtered, spacing, level=0.5)
-        print("Malla generada usando el algoritmo Marching Cubes.")
+        mesh = generate_mesh(segmentation_data_filtered, spacing, level=0.5)
+        print("Malla generada usando el algoritmo Flying Edges.")
         
-        smooth_mesh = create_smooth_mesh(verts, faces)
+        smooth_mesh = create_smooth_mesh(mesh)
         print("Malla suavizada correctamente.")
         
         visualize_mesh_advanced(smooth_mesh)
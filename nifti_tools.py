@@ -1,8 +1,46 @@
 import nibabel as nib
 import numpy as np
+from nibabel.openers import ImageOpener
+from numba import njit, prange
 import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Tuple, Optional
 
+def _is_compressed(file_path: str) -> bool:
+    """Indica si el archivo NIfTI está comprimido (.nii.gz): ahí cada lectura parcial descomprime desde el inicio."""
+    return file_path.lower().endswith('.gz')
+
+# Tamaño a partir del cual get_nifti_stats procesa el volumen por bloques
+STATS_CHUNK_BYTES = 2 * 1024 ** 3
+
+# Solo se permite reordenar sumas: volúmenes flotantes pueden traer NaN/inf
+@njit(parallel=True, fastmath={'reassoc', 'contract'}, cache=True)
+def _stats_kernel(a: np.ndarray) -> Tuple[float, float, float, float, int]:
+    """Calcula min, max, suma, suma de cuadrados y no-ceros en una sola pasada."""
+    mn = np.inf
+    mx = -np.inf
+    s = 0.0
+    s2 = 0.0
+    nz = 0
+    nans = 0
+    for i in prange(a.size):
+        v = float(a[i])
+        if v != v:
+            nans += 1
+        else:
+            mn = min(mn, v)
+            mx = max(mx, v)
+        s += v
+        s2 += v * v
+        if v != 0.0:
+            nz += 1
+    # Igual que np.min/np.max, un NaN se propaga al resultado
+    if nans > 0:
+        mn = np.nan
+        mx = np.nan
+    return mn, mx, s, s2, nz
+
 class NiftiTools:
     """
     Clase para manipular archivos NIfTI, incluyendo operaciones de división y unión
@@ -23,41 +61,66 @@ class NiftiTools:
             raise FileNotFoundError(f"No se encontró el archivo: {input_file}")
         
         img_4d = nib.load(input_file)
-        img_4d_data = img_4d.get_fdata()
+        shape = img_4d.shape
+        # En .nii.gz se descomprime una sola vez (tipo nativo); en .nii se lee por corte
+        if _is_compressed(input_file):
+            data = np.asanyarray(img_4d.dataobj)
+        else:
+            data = img_4d.dataobj
         nombre_base = os.path.basename(input_file).replace('.nii.gz', '')
         
         os.makedirs(output_folder, exist_ok=True)
         
         if split_type.lower() == "z":
             print(f"Separando en el eje Z para {nombre_base}...")
-            NiftiTools._split_by_z(img_4d_data, img_4d.affine, nombre_base, output_folder)
-        elif split_type.lower() == "t" and len(img_4d_data.shape) == 4:
+            NiftiTools._split_by_z(data, shape, img_4d.affine, img_4d.header,
+                                   nombre_base, output_folder)
+        elif split_type.lower() == "t" and len(shape) == 4:
             print(f"Separando en el tiempo para {nombre_base}...")
-            NiftiTools._split_by_time(img_4d_data, img_4d.affine, nombre_base, output_folder)
+            NiftiTools._split_by_time(data, shape, img_4d.affine, img_4d.header,
+                                      nombre_base, output_folder)
         else:
             raise ValueError("Tipo de división no válido o dimensiones incorrectas")
 
     @staticmethod
-    def _split_by_z(data: np.ndarray, affine: np.ndarray, base_name: str, output_folder: str) -> None:
-        """Helper method para dividir por eje Z."""
-        num_slices = data.shape[2]
-        for z in range(num_slices):
-            img_2d = data[:, :, z]
-            img_2d_nifti = nib.Nifti1Image(img_2d, affine)
+    def _split_by_z(dataobj, shape: Tuple[int, ...], affine: np.ndarray, header,
+                    base_name: str, output_folder: str) -> None:
+        """Helper method para dividir por eje Z (array en memoria o dataobj de un .nii)."""
+        num_slices = shape[2]
+        
+        def _save(z: int) -> int:
+            img_2d = np.asanyarray(dataobj[:, :, z])
+            img_2d_nifti = nib.Nifti1Image(img_2d, affine, header)
             output_filename = os.path.join(output_folder, f"{base_name}_slice_{z:04d}.nii.gz")
             nib.save(img_2d_nifti, output_filename)
-            print(f"Guardada rebanada Z {z+1}/{num_slices}")
+            return z
+        
+        # Cada rebanada se lee, comprime y escribe de forma independiente
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(_save, z) for z in range(num_slices)]
+            for done, future in enumerate(as_completed(futures), start=1):
+                z = future.result()
+                print(f"Guardada rebanada Z {z+1} ({done}/{num_slices})")
 
     @staticmethod
-    def _split_by_time(data: np.ndarray, affine: np.ndarray, base_name: str, output_folder: str) -> None:
-        """Helper method para dividir por tiempo."""
-        num_timepoints = data.shape[3]
-        for t in range(num_timepoints):
-            img_3d = data[..., t]
-            img_3d_nifti = nib.Nifti1Image(img_3d, affine)
+    def _split_by_time(dataobj, shape: Tuple[int, ...], affine: np.ndarray, header,
+                       base_name: str, output_folder: str) -> None:
+        """Helper method para dividir por tiempo (array en memoria o dataobj de un .nii)."""
+        num_timepoints = shape[3]
+        
+        def _save(t: int) -> int:
+            img_3d = np.asanyarray(dataobj[..., t])
+            img_3d_nifti = nib.Nifti1Image(img_3d, affine, header)
             output_filename = os.path.join(output_folder, f"{base_name}_time_{t:04d}.nii.gz")
             nib.save(img_3d_nifti, output_filename)
-            print(f"Guardado tiempo {t+1}/{num_timepoints}")
+            return t
+        
+        # Cada tiempo se lee, comprime y escribe de forma independiente
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(_save, t) for t in range(num_timepoints)]
+            for done, future in enumerate(as_completed(futures), start=1):
+                t = future.result()
+                print(f"Guardado tiempo {t+1} ({done}/{num_timepoints})")
 
     @staticmethod
     def merge_to_4d(input_folder: str, output_file: str, pattern: str = "*.nii.gz") -> None:
@@ -76,24 +139,75 @@ class NiftiTools:
         if not files:
             raise ValueError(f"No se encontraron archivos en {input_folder} con patrón {pattern}")
 
-        # Cargar primer imagen para obtener dimensiones y affine
-        first_img = nib.load(files[0])
-        first_data = first_img.get_fdata()
-        
-        # Crear array 4D
-        img_4d_data = np.zeros(first_data.shape + (len(files),))
-        
-        # Cargar cada volumen
-        for t, file in enumerate(files):
-            img = nib.load(file)
-            img_4d_data[..., t] = img.get_fdata()
-            print(f"Procesado volumen {t+1}/{len(files)}")
-        
-        # Crear y guardar imagen 4D
-        img_4d = nib.Nifti1Image(img_4d_data, first_img.affine)
-        nib.save(img_4d, output_file)
+        # Leer todos los encabezados (los datos se cargan después) para validar dimensiones
+        # y elegir un tipo de dato que represente a todos los volúmenes sin pérdida
+        images = [nib.load(file, mmap=False) for file in files]
+        first_img = images[0]
+        shape = first_img.shape
+        for file, img in zip(files, images):
+            if img.shape != shape:
+                raise ValueError(f"Dimensiones incompatibles: {file} tiene {img.shape}, se esperaba {shape}")
+        if any(img.dataobj.slope != 1 or img.dataobj.inter != 0 for img in images):
+            # Los datos escalados se leen como flotantes
+            dtype = np.dtype(np.float64)
+        else:
+            dtype = np.result_type(*(img.get_data_dtype() for img in images))
+        
+        # Crear array 4D en el tipo de dato nativo, respaldado por un archivo temporal junto
+        # a la salida; en orden Fortran cada volumen [..., t] es un bloque contiguo en disco
+        tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(output_file)),
+                                          suffix='.dat', delete=False)
+        tmp.close()
+        img_4d = img_4d_data = None
+        try:
+            img_4d_data = np.memmap(tmp.name, dtype=dtype, mode='w+',
+                                    shape=shape + (len(files),), order='F')
+            
+            # Cargar cada volumen en paralelo; cada tarea escribe en su propio corte [..., t]
+            def _load(t: int, img) -> int:
+                np.copyto(img_4d_data[..., t], np.asanyarray(img.dataobj))
+                return t
+            
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+                futures = [executor.submit(_load, t, img) for t, img in enumerate(images)]
+                for done, future in enumerate(as_completed(futures), start=1):
+                    t = future.result()
+                    print(f"Procesado volumen {t+1} ({done}/{len(files)})")
+            img_4d_data.flush()
+            
+            # Crear y guardar imagen 4D (se comprime leyendo del memmap)
+            img_4d = nib.Nifti1Image(img_4d_data, first_img.affine, first_img.header)
+            img_4d.set_data_dtype(dtype)
+            nib.save(img_4d, output_file)
+        finally:
+            # Soltar el memmap antes de borrar el archivo, también si hubo un error
+            # (en Windows un archivo mapeado no se puede eliminar)
+            img_4d = img_4d_data = None
+            os.remove(tmp.name)
         print(f"Archivo 4D guardado en {output_file}")
 
+    @staticmethod
+    def _iter_last_axis(img):
+        """
+        Genera los bloques [..., i] (aplanados) leyendo el archivo de forma secuencial
+        con un único descriptor; en .nii.gz cortar el dataobj por bloque descomprimiría
+        desde el inicio en cada lectura.
+        """
+        dataobj = img.dataobj
+        dtype = img.get_data_dtype()
+        native = dtype.newbyteorder('=')
+        count = int(np.prod(img.shape[:-1]))
+        scaled = dataobj.slope != 1 or dataobj.inter != 0
+        with ImageOpener(img.get_filename()) as fileobj:
+            fileobj.seek(dataobj.offset)
+            for _ in range(img.shape[-1]):
+                block = np.frombuffer(fileobj.read(count * dtype.itemsize), dtype=dtype)
+                # El encabezado puede ser big-endian; el kernel de Numba requiere orden nativo
+                block = block.astype(native, copy=False)
+                if scaled:
+                    block = block * dataobj.slope + dataobj.inter
+                yield block
+
     @staticmethod
     def get_nifti_stats(file_path: str) -> dict:
         """
@@ -106,16 +220,40 @@ class NiftiTools:
             dict: Diccionario con estadísticas básicas
         """
         img = nib.load(file_path)
-        data = img.get_fdata()
+        shape = img.shape
+        size = int(np.prod(shape))
+        
+        # Tipo que entrega realmente el dataobj (un archivo escalado se lee como flotante);
+        # leer un solo vóxel es barato incluso en .nii.gz
+        read_dtype = np.asanyarray(img.dataobj[(slice(0, 1),) * len(shape)]).dtype
+        
+        # Volúmenes grandes se recorren por bloques del último eje para no cargarlos completos
+        if size * read_dtype.itemsize > STATS_CHUNK_BYTES:
+            chunks = NiftiTools._iter_last_axis(img)
+        else:
+            chunks = (np.asanyarray(img.dataobj),)
+        
+        # Una sola pasada sobre los datos en su tipo nativo (el conteo de no-ceros va en el mismo kernel)
+        mn, mx, s, s2, nz = np.inf, -np.inf, 0.0, 0.0, 0
+        for chunk in chunks:
+            # Numba no admite orden de bytes no nativo (p. ej. '>i2' sin escalado); no-op si ya es nativo
+            chunk = chunk.astype(chunk.dtype.newbyteorder('='), copy=False)
+            c_mn, c_mx, c_s, c_s2, c_nz = _stats_kernel(chunk.ravel(order='K'))
+            mn, mx = np.minimum(mn, c_mn), np.maximum(mx, c_mx)
+            s += c_s
+            s2 += c_s2
+            nz += c_nz
+        mean = s / size
+        std = np.sqrt(max(s2 / size - mean ** 2, 0.0))
         
         stats = {
-            "dimensions": data.shape,
-            "min_value": float(np.min(data)),
-            "max_value": float(np.max(data)),
-            "mean_value": float(np.mean(data)),
-            "std_value": float(np.std(data)),
-            "non_zero_voxels": int(np.sum(data != 0)),
-            "total_voxels": int(data.size),
+            "dimensions": shape,
+            "min_value": float(mn),
+            "max_value": float(mx),
+            "mean_value": float(mean),
+            "std_value": float(std),
+            "non_zero_voxels": int(nz),
+            "total_voxels": size,
             "affine": img.affine.tolist()
         }
         
@@ -1,9 +1,12 @@
 import nibabel as nib
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.transforms import Bbox
 from matplotlib.widgets import Slider
 import os
-from typing import List, Optional, Tuple
+from nibabel.arrayproxy import ArrayProxy
+from nibabel.openers import ImageOpener
+from typing import List, Optional, Tuple, Union
 
 class NiftiVisualizer:
     """
@@ -17,6 +20,12 @@ class NiftiVisualizer:
         self.axes = None
         self.sliders = {}
         self.images = {}
+        # Volúmenes mostrados; los callbacks los leen desde aquí en vez de capturarlos
+        self._data1 = None
+        self._data2 = None
+        self._masked_seg = None
+        # Regiones de la figura con su fondo guardado, para redibujar solo lo que cambia
+        self._blit_cache = None
     
     def setup_display(self, num_subplots: int = 1) -> None:
         """Configura la pantalla de visualización."""
@@ -24,6 +33,21 @@ class NiftiVisualizer:
         if num_subplots == 1:
             self.axes = [self.axes]
         plt.subplots_adjust(bottom=0.25)
+        self.fig.canvas.mpl_connect('close_event', lambda event: self.close())
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def close(self) -> None:
+        """Cierra la figura y libera los volúmenes y widgets retenidos."""
+        fig, self.fig = self.fig, None
+        if fig is not None:
+            plt.close(fig)
+        self.axes = None
+        self._data1 = None
+        self._data2 = None
+        self._masked_seg = None
+        self._blit_cache = None
+        self.sliders.clear()
+        self.images.clear()
 
     def add_slider(self, name: str, valmin: int, valmax: int, valinit: int) -> None:
         """Añade un slider a la visualización."""
@@ -33,6 +57,77 @@ class NiftiVisualizer:
             valinit=valinit, valstep=1
         )
 
+    def _enable_blitting(self) -> None:
+        """Marca como animados los artistas que cambian con los sliders.
+
+        Solo si el backend soporta blitting; si no, se mantiene el redibujado
+        completo habitual.
+        """
+        if not self.fig.canvas.supports_blit:
+            return
+        for image in self.images.values():
+            image.set_animated(True)
+        for ax in self.axes:
+            ax.title.set_animated(True)
+        for slider in self.sliders.values():
+            slider.ax.set_animated(True)
+            # El slider no fuerza un redibujado completo; lo actualiza _refresh
+            slider.drawon = False
+
+    def _blit_targets(self, renderer) -> List[Tuple[Bbox, list]]:
+        """Regiones que se redibujan en cada movimiento y los artistas de cada una."""
+        fig_box = self.fig.bbox
+        targets = []
+        for ax in self.axes:
+            # Eje más la franja superior donde está el título
+            region = Bbox.from_extents(ax.bbox.x0, ax.bbox.y0, ax.bbox.x1, fig_box.y1)
+            artists = [image for image in self.images.values() if image.axes is ax]
+            targets.append((region, artists + [ax.title]))
+        for slider in self.sliders.values():
+            # Franja completa del slider: etiqueta, manija y texto con su valor
+            # (2 px extra para cubrir el antialiasing de la manija)
+            slider_box = slider.ax.get_tightbbox(renderer)
+            region = Bbox.from_extents(fig_box.x0, slider_box.y0 - 2, fig_box.x1, slider_box.y1 + 2)
+            targets.append((region, [slider.ax]))
+        return targets
+
+    def _on_draw(self, event) -> None:
+        """Tras un redibujado completo guarda el fondo de cada región y pinta los artistas animados."""
+        canvas = self.fig.canvas
+        if not canvas.supports_blit:
+            return
+        self._blit_cache = [
+            (region, canvas.copy_from_bbox(region), artists)
+            for region, artists in self._blit_targets(event.renderer)
+        ]
+        for _, _, artists in self._blit_cache:
+            for artist in artists:
+                self.fig.draw_artist(artist)
+
+    def _refresh(self) -> None:
+        """Redibuja solo imágenes, títulos y sliders sobre el fondo guardado."""
+        canvas = self.fig.canvas
+        if self._blit_cache is None:
+            canvas.draw_idle()
+            return
+        for region, background, artists in self._blit_cache:
+            canvas.restore_region(background)
+            for artist in artists:
+                self.fig.draw_artist(artist)
+            canvas.blit(region)
+        canvas.flush_events()
+
+    @staticmethod
+    def _volume_data(img, file_path: str) -> Union[np.ndarray, ArrayProxy]:
+        """
+        Devuelve los datos en su tipo nativo. Un .nii 4D sin comprimir se deja como
+        dataobj para leer solo el corte visible; un .nii.gz se descomprime una sola vez,
+        ya que cada lectura parcial del gzip empieza desde el inicio del archivo.
+        """
+        if len(img.shape) == 4 and not file_path.lower().endswith('.gz'):
+            return img.dataobj
+        return np.asanyarray(img.dataobj)
+
     def view_single_volume(self, file_path: str) -> None:
         """
         Visualiza un único volumen NIfTI (3D o 4D).
@@ -40,43 +135,83 @@ class NiftiVisualizer:
         Args:
             file_path (str): Ruta al archivo NIfTI
         """
-        img = nib.load(file_path)
-        data = img.get_fdata()
+        img = nib.load(file_path, mmap=False)
         
         self.setup_display(1)
         
-        if len(data.shape) == 3:
+        data = self._volume_data(img, file_path)
+        
+        if len(img.shape) == 3:
             self._setup_3d_view(data)
-        elif len(data.shape) == 4:
+        elif len(img.shape) == 4:
             self._setup_4d_view(data)
         else:
             raise ValueError("Solo se soportan volúmenes 3D o 4D")
         
+        self._enable_blitting()
         plt.show()
 
+    @staticmethod
+    def _intensity_range(data: Union[np.ndarray, ArrayProxy]) -> Tuple[float, float]:
+        """
+        Calcula (vmin, vmax) una sola vez ignorando NaN, como el autoescalado de imshow.
+        Un dataobj (.nii sin comprimir) se recorre volumen a volumen en una sola pasada
+        secuencial con un único descriptor. Si todo es NaN se usa (0.0, 1.0).
+        """
+        # fmin/fmax equivalen a nanmin/nanmax sin avisos en bloques completamente NaN
+        if isinstance(data, np.ndarray):
+            vmin, vmax = np.fmin.reduce(data, axis=None), np.fmax.reduce(data, axis=None)
+            if np.isnan(vmin):
+                return 0.0, 1.0
+            return float(vmin), float(vmax)
+        vmin, vmax = np.nan, np.nan
+        count = int(np.prod(data.shape[:-1]))
+        with ImageOpener(data.file_like) as fileobj:
+            fileobj.seek(data.offset)
+            for _ in range(data.shape[-1]):
+                volume = np.frombuffer(fileobj.read(count * data.dtype.itemsize), dtype=data.dtype)
+                vmin = np.fmin(vmin, np.fmin.reduce(volume))
+                vmax = np.fmax(vmax, np.fmax.reduce(volume))
+        if np.isnan(vmin):
+            return 0.0, 1.0
+        # Aplicar el escalado del encabezado a los extremos (una pendiente negativa los invierte)
+        low, high = vmin * data.slope + data.inter, vmax * data.slope + data.inter
+        return float(min(low, high)), float(max(low, high))
+
     def _setup_3d_view(self, data: np.ndarray) -> None:
         """Configura visualización para volumen 3D."""
+        # Convertir una sola vez a float32 y fijar la escala de colores
+        data = data.astype(np.float32, copy=False)
+        self._data1 = data
+        vmin, vmax = self._intensity_range(data)
+        
         slice_z = data.shape[2] // 2
-        self.images['main'] = self.axes[0].imshow(data[:, :, slice_z], cmap='gray')
+        self.images['main'] = self.axes[0].imshow(
+            data[:, :, slice_z], cmap='gray', vmin=vmin, vmax=vmax
+        )
         self.axes[0].set_title(f'Corte Z={slice_z}')
         
         self.add_slider('Z', 0, data.shape[2]-1, slice_z)
         
         def update(val):
             z = int(self.sliders['Z'].val)
-            self.images['main'].set_data(data[:, :, z])
+            self.images['main'].set_data(self._data1[:, :, z])
             self.axes[0].set_title(f'Corte Z={z}')
-            self.fig.canvas.draw_idle()
+            self._refresh()
         
         self.sliders['Z'].on_changed(update)
 
-    def _setup_4d_view(self, data: np.ndarray) -> None:
-        """Configura visualización para volumen 4D."""
+    def _setup_4d_view(self, data: Union[np.ndarray, ArrayProxy]) -> None:
+        """Configura visualización para volumen 4D (acepta el dataobj de un .nii sin cargar)."""
+        self._data1 = data
+        # Escala de colores fija; cada corte leído se convierte a float32
+        vmin, vmax = self._intensity_range(data)
         slice_z = data.shape[2] // 2
         time_point = 0
         
         self.images['main'] = self.axes[0].imshow(
-            data[:, :, slice_z, time_point], cmap='gray'
+            np.asarray(data[:, :, slice_z, time_point], dtype=np.float32),
+            cmap='gray', vmin=vmin, vmax=vmax
         )
         self.axes[0].set_title(f'Tiempo={time_point}, Corte Z={slice_z}')
         
@@ -86,9 +221,9 @@ class NiftiVisualizer:
         def update(val):
             z = int(self.sliders['Z'].val)
             t = int(self.sliders['T'].val)
-            self.images['main'].set_data(data[:, :, z, t])
+            self.images['main'].set_data(np.asarray(self._data1[:, :, z, t], dtype=np.float32))
             self.axes[0].set_title(f'Tiempo={t}, Corte Z={z}')
-            self.fig.canvas.draw_idle()
+            self._refresh()
         
         for slider in self.sliders.values():
             slider.on_changed(update)
@@ -103,26 +238,29 @@ class NiftiVisualizer:
             file_path2 (str): Ruta al segundo archivo NIfTI
             titles (tuple): Títulos para cada imagen
         """
-        img1 = nib.load(file_path1)
-        img2 = nib.load(file_path2)
-        data1 = img1.get_fdata()
-        data2 = img2.get_fdata()
+        img1 = nib.load(file_path1, mmap=False)
+        img2 = nib.load(file_path2, mmap=False)
         
-        if data1.shape != data2.shape:
+        if img1.shape != img2.shape:
             raise ValueError("Los volúmenes deben tener las mismas dimensiones")
         
         self.setup_display(2)
         
-        if len(data1.shape) == 3:
+        data1 = self._volume_data(img1, file_path1)
+        data2 = self._volume_data(img2, file_path2)
+        
+        if len(img1.shape) == 3:
             self._setup_3d_comparison(data1, data2, titles)
-        elif len(data1.shape) == 4:
+        elif len(img1.shape) == 4:
             self._setup_4d_comparison(data1, data2, titles)
         
+        self._enable_blitting()
         plt.show()
 
     def _setup_3d_comparison(self, data1: np.ndarray, data2: np.ndarray, 
                            titles: Tuple[str, str]) -> None:
         """Configura comparación de volúmenes 3D."""
+        self._data1, self._data2 = data1, data2
         slice_z = data1.shape[2] // 2
         
         self.images['left'] = self.axes[0].imshow(data1[:, :, slice_z], cmap='gray')
@@ -135,17 +273,19 @@ class NiftiVisualizer:
         
         def update(val):
             z = int(self.sliders['Z'].val)
-            self.images['left'].set_data(data1[:, :, z])
-            self.images['right'].set_data(data2[:, :, z])
+            self.images['left'].set_data(self._data1[:, :, z])
+            self.images['right'].set_data(self._data2[:, :, z])
             self.axes[0].set_title(f'{titles[0]} - Corte Z={z}')
             self.axes[1].set_title(f'{titles[1]} - Corte Z={z}')
-            self.fig.canvas.draw_idle()
+            self._refresh()
         
         self.sliders['Z'].on_changed(update)
 
-    def _setup_4d_comparison(self, data1: np.ndarray, data2: np.ndarray, 
+    def _setup_4d_comparison(self, data1: Union[np.ndarray, ArrayProxy],
+                           data2: Union[np.ndarray, ArrayProxy],
                            titles: Tuple[str, str]) -> None:
-        """Configura comparación de volúmenes 4D."""
+        """Configura comparación de volúmenes 4D (acepta el dataobj de un .nii sin cargar)."""
+        self._data1, self._data2 = data1, data2
         slice_z = data1.shape[2] // 2
         time_point = 0
         
@@ -165,11 +305,11 @@ class NiftiVisualizer:
         def update(val):
             z = int(self.sliders['Z'].val)
             t = int(self.sliders['T'].val)
-            self.images['left'].set_data(data1[:, :, z, t])
-            self.images['right'].set_data(data2[:, :, z, t])
+            self.images['left'].set_data(self._data1[:, :, z, t])
+            self.images['right'].set_data(self._data2[:, :, z, t])
             self.axes[0].set_title(f'{titles[0]} - T={t}, Z={z}')
             self.axes[1].set_title(f'{titles[1]} - T={t}, Z={z}')
-            self.fig.canvas.draw_idle()
+            self._refresh()
         
         for slider in self.sliders.values():
             slider.on_changed(update)
@@ -182,36 +322,39 @@ class NiftiVisualizer:
             original_path (str): Ruta a la imagen original
             segmentation_path (str): Ruta a la segmentación
         """
-        img_original = nib.load(original_path)
-        img_seg = nib.load(segmentation_path)
+        img_original = nib.load(original_path, mmap=False)
+        img_seg = nib.load(segmentation_path, mmap=False)
         
-        data_original = img_original.get_fdata()
-        data_seg = img_seg.get_fdata()
-        
-        if data_original.shape != data_seg.shape:
+        if img_original.shape != img_seg.shape:
             raise ValueError("La imagen original y la segmentación deben tener las mismas dimensiones")
         
         self.setup_display(1)
-        slice_z = data_original.shape[2] // 2
-        time_point = 0 if len(data_original.shape) == 4 else None
+        slice_z = img_original.shape[2] // 2
+        time_point = 0 if len(img_original.shape) == 4 else None
         
         # Configurar visualización inicial
+        data_original = self._volume_data(img_original, original_path)
+        data_seg = self._volume_data(img_seg, segmentation_path)
         if time_point is not None:
             self._setup_4d_overlay(data_original, data_seg, slice_z, time_point)
         else:
             self._setup_3d_overlay(data_original, data_seg, slice_z)
         
+        self._enable_blitting()
         plt.show()
 
     def _setup_3d_overlay(self, data_original: np.ndarray, data_seg: np.ndarray, 
                          slice_z: int) -> None:
         """Configura superposición para volúmenes 3D."""
+        self._data1 = data_original
         # Mostrar imagen original
         self.images['base'] = self.axes[0].imshow(data_original[:, :, slice_z], cmap='gray')
         
-        # Superponer segmentación
-        masked_seg = np.ma.masked_where(data_seg[:, :, slice_z] == 0, data_seg[:, :, slice_z])
-        self.images['overlay'] = self.axes[0].imshow(masked_seg, cmap='jet', alpha=0.5)
+        # Superponer segmentación (máscara calculada una sola vez para todo el volumen)
+        self._masked_seg = np.ma.masked_equal(data_seg, 0)
+        self.images['overlay'] = self.axes[0].imshow(
+            self._masked_seg[:, :, slice_z], cmap='jet', alpha=0.5
+        )
         
         self.axes[0].set_title(f'Segmentación superpuesta - Corte Z={slice_z}')
         
@@ -219,28 +362,29 @@ class NiftiVisualizer:
         
         def update(val):
             z = int(self.sliders['Z'].val)
-            self.images['base'].set_data(data_original[:, :, z])
-            masked_seg = np.ma.masked_where(data_seg[:, :, z] == 0, data_seg[:, :, z])
-            self.images['overlay'].set_data(masked_seg)
+            self.images['base'].set_data(self._data1[:, :, z])
+            self.images['overlay'].set_data(self._masked_seg[:, :, z])
             self.axes[0].set_title(f'Segmentación superpuesta - Corte Z={z}')
-            self.fig.canvas.draw_idle()
+            self._refresh()
         
         self.sliders['Z'].on_changed(update)
 
-    def _setup_4d_overlay(self, data_original: np.ndarray, data_seg: np.ndarray,
+    def _setup_4d_overlay(self, data_original: Union[np.ndarray, ArrayProxy],
+                         data_seg: Union[np.ndarray, ArrayProxy],
                          slice_z: int, time_point: int) -> None:
-        """Configura superposición para volúmenes 4D."""
+        """Configura superposición para volúmenes 4D (acepta el dataobj de un .nii sin cargar)."""
+        self._data1 = data_original
         # Mostrar imagen original
         self.images['base'] = self.axes[0].imshow(
             data_original[:, :, slice_z, time_point], cmap='gray'
         )
         
-        # Superponer segmentación
-        masked_seg = np.ma.masked_where(
-            data_seg[:, :, slice_z, time_point] == 0,
-            data_seg[:, :, slice_z, time_point]
+        # Superponer segmentación (máscara calculada una sola vez; las etiquetas
+        # se cargan completas en su tipo nativo, la imagen original se sigue leyendo por corte)
+        self._masked_seg = np.ma.masked_equal(np.asanyarray(data_seg), 0)
+        self.images['overlay'] = self.axes[0].imshow(
+            self._masked_seg[:, :, slice_z, time_point], cmap='jet', alpha=0.5
         )
-        self.images['overlay'] = self.axes[0].imshow(masked_seg, cmap='jet', alpha=0.5)
         
         self.axes[0].set_title(f'Segmentación superpuesta - T={time_point}, Z={slice_z}')
         
@@ -250,11 +394,10 @@ class NiftiVisualizer:
         def update(val):
             z = int(self.sliders['Z'].val)
             t = int(self.sliders['T'].val)
-            self.images['base'].set_data(data_original[:, :, z, t])
-            masked_seg = np.ma.masked_where(data_seg[:, :, z, t] == 0, data_seg[:, :, z, t])
-            self.images['overlay'].set_data(masked_seg)
+            self.images['base'].set_data(self._data1[:, :, z, t])
+            self.images['overlay'].set_data(self._masked_seg[:, :, z, t])
             self.axes[0].set_title(f'Segmentación superpuesta - T={t}, Z={z}')
-            self.fig.canvas.draw_idle()
+            self._refresh()
         
         for slider in self.sliders.values():
             slider.on_changed(update)